@@ -21,9 +21,23 @@ import io
 import os
 import re
 import sys
+import json
+import math
+import time
+import random
+import socket
+import sqlite3
+import hashlib
 import argparse
+import itertools
+import threading
 from collections import namedtuple
 
+try:
+    unichr
+except NameError:
+    unichr = chr
+
 __author__  = "c0re"
 __version__ = "3.2.0-dev"
 __github__  = "https://github.com/psypanda/hashID"
@@ -32,6 +46,7 @@ __banner__  = "hashID v{0} by {1} ({2})".format(__version__, __author__, __githu
 
 Prototype = namedtuple('Prototype', ['regex', 'modes'])
 HashInfo = namedtuple('HashInfo', ['name', 'hashcat', 'john', 'extended'])
+HashField = namedtuple('HashField', ['username', 'hash'])
 
 prototypes = [
     Prototype(
@@ -744,39 +759,1098 @@ prototypes = [
 ]
 
 
+# Hash types tried first when only the most likely types are requested
+priority = ['MD5', 'NTLM', 'SHA-1', 'SHA-256', 'SHA-512', 'bcrypt', 'SHA-512 Crypt', 'SHA-256 Crypt',
+            'MD5 Crypt', 'DEScrypt', 'MySQL5.x', 'NetNTLMv2', 'LM']
+
+
+def modeMatches(mode, terms):
+    """Returns whether a HashInfo is named by any term (name, hashcat mode or JtR format)"""
+    names = [mode.name.lower()]
+    if mode.hashcat is not None:
+        names.append(str(mode.hashcat))
+    if mode.john is not None:
+        names.append(mode.john.lower())
+    for term in terms:
+        if term.strip().lower() in names:
+            return True
+    return False
+
+
 class HashID(object):
 
     """HashID with configurable prototypes"""
 
-    def __init__(self, prototypes=prototypes):
+    def __init__(self, prototypes=prototypes, priority=priority, only=None, exclude=None, extended=True):
         super(HashID, self).__init__()
 
-        # Set self.prototypes to a copy of prototypes to allow
-        # modification after instantiation
-        self.prototypes = list(prototypes)
+        # Set self.prototypes to a pruned copy of prototypes holding only
+        # the wanted modes. The lookup tables below are built once, so
+        # modifying prototypes after instantiation is not supported.
+        # Prototype indexes handed out refer to the unpruned prototypes, so
+        # they stay the same whatever was pruned
+        self.source = prototypes
+        self.prototypes = []
+        self.sourceIndexes = []
+        self.prunedIndexes = {}
+        for sourceIndex, prototype in enumerate(prototypes):
+            modes = [mode for mode in prototype.modes
+                     if (extended or not mode.extended) and
+                     (not only or modeMatches(mode, only)) and
+                     not (exclude and modeMatches(mode, exclude))]
+            if modes:
+                self.prunedIndexes[sourceIndex] = len(self.prototypes)
+                self.sourceIndexes.append(sourceIndex)
+                self.prototypes.append(Prototype(regex=prototype.regex, modes=modes))
+
+        # Rank every mode by its position in priority, keeping the
+        # prototype order for all others; used by limited identification.
+        # Neighbouring modes of the same prototype share one entry, and
+        # only the first entry of a prototype carries its regex
+        rank = dict((name, position) for position, name in enumerate(priority))
+        ranked = []
+        for index, prototype in enumerate(self.prototypes):
+            for mode in prototype.modes:
+                ranked.append((index, prototype.regex, mode))
+        ranked.sort(key=lambda entry: rank.get(entry[2].name, len(priority)))
+        self.ranking = []
+        for index, regex, mode in ranked:
+            if self.ranking and self.ranking[-1][0] == index:
+                self.ranking[-1][2].append(mode)
+            else:
+                self.ranking.append((index, regex, [mode]))
+        seen = set()
+        self.lazyRanking = []
+        for index, regex, modes in self.ranking:
+            self.lazyRanking.append((index, None if index in seen else regex, modes))
+            seen.add(index)
 
-    def identifyHash(self, phash):
-        """Returns identified HashInfo"""
+    def identifyPrototypes(self, phash, pruned=True):
+        """Returns indexes of matching prototypes in the unpruned prototypes
+
+        Only prototypes left after pruning are tried unless pruned is False."""
         phash = phash.strip()
-        for prototype in self.prototypes:
+        if pruned:
+            candidates = zip(self.sourceIndexes, self.prototypes)
+        else:
+            candidates = enumerate(self.source)
+        for index, prototype in candidates:
             if prototype.regex.match(phash):
-                for mode in prototype.modes:
+                yield index
+
+    def modesOf(self, indexes, limit=None):
+        """Returns HashInfo of matching prototype indexes as identifyHash would
+
+        Indexes refer to the unpruned prototypes; pruned ones are ignored."""
+        indexes = [self.prunedIndexes[index] for index in indexes if index in self.prunedIndexes]
+        if limit is None:
+            for index in indexes:
+                for mode in self.prototypes[index].modes:
                     yield mode
+            return
+        indexes = set(indexes)
+        for index, regex, modes in self.ranking:
+            if index in indexes:
+                for mode in modes:
+                    yield mode
+                    limit -= 1
+                    if not limit:
+                        return
+
+    def identifyHash(self, phash, limit=None):
+        """Returns identified HashInfo
+
+        With a limit, modes are tried in priority order and identification
+        stops as soon as limit modes have been found."""
+        phash = phash.strip()
+        if limit is None:
+            for prototype in self.prototypes:
+                if prototype.regex.match(phash):
+                    for mode in prototype.modes:
+                        yield mode
+            return
+        matched = set()
+        for index, regex, modes in self.lazyRanking:
+            if regex is not None:
+                if not regex.match(phash):
+                    continue
+                matched.add(index)
+            elif index not in matched:
+                continue
+            for mode in modes:
+                yield mode
+                limit -= 1
+                if not limit:
+                    return
+
+
+def parseShadowLine(line, hashID=None):
+    """Returns the HashField of a /etc/shadow line"""
+    fields = line.split(":")
+    if len(fields) < 2:
+        return [HashField(username=None, hash=line)]
+    # Locked accounts keep their hash behind one or more "!"
+    phash = fields[1].lstrip("!")
+    if phash in ("", "*", "x"):
+        return []
+    return [HashField(username=fields[0], hash=phash)]
+
+
+def parsePwdumpLine(line, hashID=None):
+    """Returns the LM and NT HashFields of a pwdump 'user:rid:lm:nt:::' line"""
+    fields = line.split(":")
+    if len(fields) < 4:
+        return [HashField(username=None, hash=line)]
+    found = []
+    for phash in fields[2:4]:
+        # Skip the placeholders pwdump writes for empty or missing hashes
+        if phash and phash.lower() != "aad3b435b51404eeaad3b435b51404ee" and not phash.startswith("NO PASSWORD"):
+            found.append(HashField(username=fields[0], hash=phash))
+    return found
+
+
+def parseHtpasswdLine(line, hashID=None):
+    """Returns the HashField of a htpasswd 'user:hash' line"""
+    username, sep, phash = line.partition(":")
+    if not sep:
+        return [HashField(username=None, hash=line)]
+    return [HashField(username=username, hash=phash)]
+
+
+def parsePotfileLine(line, hashID=None):
+    """Returns the HashField of a potfile 'hash:plain' line
+
+    Hashes and plaintexts may both contain colons, so the line is split
+    at the first colon after a prefix hashID identifies. Without hashID,
+    or if no prefix is identified, everything after the last colon is
+    assumed to be the plaintext."""
+    if hashID is not None:
+        position = line.find(":")
+        while position != -1:
+            if next(hashID.identifyHash(line[:position], 1), None) is not None:
+                return [HashField(username=None, hash=line[:position])]
+            position = line.find(":", position + 1)
+    phash, sep, plain = line.rpartition(":")
+    if not sep:
+        return [HashField(username=None, hash=line)]
+    return [HashField(username=None, hash=phash)]
+
+
+lineFormats = {
+    'shadow': parseShadowLine,
+    'pwdump': parsePwdumpLine,
+    'htpasswd': parseHtpasswdLine,
+    'potfile': parsePotfileLine
+}
+
+
+def parseLine(line, lineFormat=None, hashID=None):
+    """Returns the HashFields contained in a line of the given format
+
+    Some formats are ambiguous and use hashID to find the hash field."""
+    line = line.strip()
+    if lineFormat is None:
+        return [HashField(username=None, hash=line)]
+    return lineFormats[lineFormat](line, hashID)
+
+
+# Characters hashes are built from in the prototypes above; anything else
+# (whitespace, quotes, colons, commas, brackets...) separates two tokens.
+# Up to two "=" of Base64 padding may end a token but never continue one
+tokenChars = b"a-zA-Z0-9$./+*{}_-"
+tokenAlphabet = b"abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789$./+*{}_-"
+tokenBytes = frozenset(bytearray(tokenAlphabet))
+
+
+def scanTokens(infile, minLength=16, maxLength=4096, chunkSize=1 << 20):
+    """Yields (byte offset, token) of candidate hashes in a binary stream
+
+    The stream is read in chunks and matched with a single regular
+    expression; a token crossing the end of a chunk is carried over
+    to the next one."""
+    tokenRegex = re.compile(br"[" + tokenChars + br"]{" + str(minLength).encode() + br",}={0,2}")
+    offset = 0
+    buf = b""
+    skipping = False
+    while True:
+        chunk = infile.read(chunkSize)
+        if not chunk:
+            for match in tokenRegex.finditer(buf):
+                if match.end() - match.start() <= maxLength:
+                    yield offset + match.start(), match.group().decode("ascii")
+            break
+        if skipping:
+            # Drop the remainder of a run too long to be a hash
+            rest = chunk.lstrip(tokenAlphabet)
+            offset += len(chunk) - len(rest)
+            skipping = not rest
+            chunk = rest
+        buf += chunk
+        # Leave a trailing run of token characters and its padding for the next chunk
+        cut = len(buf)
+        limit = max(0, cut - maxLength - 3)
+        while cut > limit and buf[cut - 1:cut] == b"=":
+            cut -= 1
+        if len(buf) - cut > 2:
+            # More padding than a token takes, so the run before it is complete
+            cut = len(buf)
+        while cut > limit and bytearray(buf[cut - 1:cut])[0] in tokenBytes:
+            cut -= 1
+        if cut == limit and limit > 0:
+            cut = len(buf)
+            skipping = True
+        for match in tokenRegex.finditer(buf, 0, cut):
+            if match.end() - match.start() <= maxLength:
+                yield offset + match.start(), match.group().decode("ascii")
+        offset += cut
+        buf = buf[cut:]
+
+
+def scanText(hashID, infile, minLength=16, limit=None):
+    """Yields (byte offset, token, identified HashInfo) of hashes found in a binary stream
+
+    Tokens without a single digit (words, paths, identifiers) are skipped.
+    Results are cached per token as hashes tend to repeat in logs and dumps."""
+    cache = {}
+    digits = re.compile(r"[0-9]")
+
+    def identify(token):
+        return list(hashID.identifyHash(token, limit))
+
+    for offset, token in scanTokens(infile, minLength):
+        found = cache.get(token)
+        if found is None:
+            found = (token, [])
+            if digits.search(token):
+                found = (token, identify(token))
+                if not found[1] and token.endswith("."):
+                    # Trailing dot most likely ends a sentence
+                    found = (token.rstrip("."), identify(token.rstrip(".")))
+            if len(cache) > 65536:
+                cache.clear()
+            cache[token] = found
+        if found[1]:
+            yield offset, found[0], found[1]
+
+
+def followLines(paths, interval=1.0, chunkSize=1 << 20):
+    """Yields batches of (path, line) appended to files, like tail -F
+
+    Files are read from their current end. A file whose inode changes is
+    reopened from the start after its old handle is drained (rotation),
+    one that shrinks is read again from the start (truncation) and one
+    that does not exist yet is picked up once it appears. Each batch holds
+    what was appended within one polling interval."""
+    watched = dict((path, None) for path in paths)
+    for path in paths:
+        try:
+            infile = io.open(path, "rb")
+            infile.seek(0, os.SEEK_END)
+            watched[path] = [infile, b""]
+        except EnvironmentError:
+            pass
+    while True:
+        batch = []
+        for path in paths:
+            state = watched[path]
+            if state is None:
+                try:
+                    watched[path] = state = [io.open(path, "rb"), b""]
+                except EnvironmentError:
+                    continue
+            infile = state[0]
+            data = infile.read(chunkSize)
+            if not data:
+                try:
+                    stat = os.stat(path)
+                except EnvironmentError:
+                    continue
+                if stat.st_ino != os.fstat(infile.fileno()).st_ino:
+                    infile.close()
+                    watched[path] = None
+                    if state[1]:
+                        batch.append((path, state[1]))
+                    continue
+                if stat.st_size < infile.tell():
+                    infile.seek(0)
+                    state[1] = b""
+                continue
+            lines = (state[1] + data).split(b"\n")
+            state[1] = lines.pop()
+            batch.extend((path, line) for line in lines)
+        if batch:
+            yield [(path, line.decode("utf-8", "replace")) for path, line in batch]
+        else:
+            time.sleep(interval)
+
+
+def sampleFile(infile, count, rng=random):
+    """Returns (line, weight) pairs sampled from a seekable binary file
+
+    The file is split into count strata of equal byte size and the line
+    holding a random offset in each stratum is read. Longer lines are more
+    likely to be hit, so every line is weighted by the inverse of its length."""
+    infile.seek(0, os.SEEK_END)
+    size = infile.tell()
+    samples = []
+    if not size:
+        return samples
+    stratum = float(size) / count
+    for i in range(count):
+        offset = int((i + rng.random()) * stratum)
+        start = max(0, offset - 65536)
+        infile.seek(start)
+        before = infile.read(offset - start)
+        lineStart = start + before.rfind(b"\n") + 1
+        infile.seek(lineStart)
+        line = infile.readline()
+        samples.append((line.decode("utf-8", "replace"), 1.0 / len(line)))
+    return samples
+
+
+def sampleStream(infile, count=None, rate=None, rng=random):
+    """Returns (line, weight) pairs sampled from a stream
+
+    Either a reservoir of count lines or each line with probability rate."""
+    samples = []
+    for seen, line in enumerate(infile):
+        if rate is not None:
+            if rng.random() < rate:
+                samples.append((line, 1.0))
+        elif seen < count:
+            samples.append((line, 1.0))
+        else:
+            replace = rng.randint(0, seen)
+            if replace < count:
+                samples[replace] = (line, 1.0)
+    return samples
+
+
+SampleEstimate = namedtuple('SampleEstimate', ['name', 'proportion', 'low', 'high'])
+
+
+def estimateProportions(hashID, samples, lineFormat=None, limit=None, z=1.96):
+    """Returns the estimated share of each hash type among sampled (line, weight) pairs
+
+    Intervals are Wilson score intervals over the effective sample size of
+    the weighted sample. Unidentified hashes are reported as 'Unknown hash'."""
+    totals = {}
+    order = []
+    weightSum = 0.0
+    squareSum = 0.0
+    for line, weight in samples:
+        if not line.strip():
+            continue
+        for field in parseLine(line, lineFormat, hashID):
+            weightSum += weight
+            squareSum += weight * weight
+            names = []
+            for mode in hashID.identifyHash(field.hash, limit):
+                if mode.name not in names:
+                    names.append(mode.name)
+            for name in names or ["Unknown hash"]:
+                if name not in totals:
+                    totals[name] = 0.0
+                    order.append(name)
+                totals[name] += weight
+    estimates = []
+    if not weightSum:
+        return estimates
+    n = weightSum * weightSum / squareSum
+    for name in order:
+        p = totals[name] / weightSum
+        center = (p + z * z / (2 * n)) / (1 + z * z / n)
+        spread = z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n)) / (1 + z * z / n)
+        estimates.append(SampleEstimate(name=name, proportion=p, low=max(0.0, center - spread), high=min(1.0, center + spread)))
+    estimates.sort(key=lambda estimate: -estimate.proportion)
+    return estimates
+
+
+def writeEstimates(estimates, outfile):
+    """Write human readable output from estimateProportions"""
+    for estimate in estimates:
+        outfile.write(u"[+] {0} {1:.1%} ({2:.1%} - {3:.1%})\n".format(
+            estimate.name, estimate.proportion, estimate.low, estimate.high))
+
+
+columnFormats = {
+    '.csv': 'csv',
+    '.arrow': 'arrow',
+    '.feather': 'arrow',
+    '.ipc': 'arrow',
+    '.parquet': 'parquet'
+}
+
+
+def readBatches(path, batchSize=65536, columnName=None):
+    """Yields pyarrow RecordBatches of a CSV, Arrow IPC or Parquet file
+
+    batchSize only applies to Parquet; CSV is read in 4 MiB blocks and
+    Arrow IPC in the batches it was written with. The CSV column columnName
+    is read as strings, so all-digit hashes keep their leading zeros."""
+    import pyarrow
+    columnFormat = columnFormats.get(os.path.splitext(path)[1].lower())
+    if columnFormat == 'csv':
+        import pyarrow.csv
+        columnTypes = {columnName: pyarrow.string()} if columnName is not None else {}
+        for batch in pyarrow.csv.open_csv(path, read_options=pyarrow.csv.ReadOptions(block_size=1 << 22),
+                                          convert_options=pyarrow.csv.ConvertOptions(column_types=columnTypes)):
+            yield batch
+    elif columnFormat == 'arrow':
+        import pyarrow.ipc
+        with pyarrow.memory_map(path) as source:
+            try:
+                reader = pyarrow.ipc.open_file(source)
+                batches = (reader.get_batch(i) for i in range(reader.num_record_batches))
+            except pyarrow.ArrowInvalid:
+                source.seek(0)
+                batches = pyarrow.ipc.open_stream(source)
+            for batch in batches:
+                yield batch
+    elif columnFormat == 'parquet':
+        import pyarrow.parquet
+        for batch in pyarrow.parquet.ParquetFile(path).iter_batches(batch_size=batchSize):
+            yield batch
+    else:
+        raise ValueError("Unknown columnar format of {0}".format(path))
+
+
+class BatchWriter(object):
+
+    """Writes pyarrow RecordBatches to a CSV, Arrow IPC or Parquet file"""
+
+    def __init__(self, path):
+        super(BatchWriter, self).__init__()
+        self.path = path
+        self.format = columnFormats.get(os.path.splitext(path)[1].lower())
+        if self.format is None:
+            raise ValueError("Unknown columnar format of {0}".format(path))
+        self.writer = None
+
+    def write(self, batch):
+        """Write a RecordBatch, opening the file on the first one"""
+        import pyarrow
+        import pyarrow.compute
+        if self.format == 'csv':
+            # CSV has no list type, so join lists into one string per cell
+            columns = []
+            for column in batch.columns:
+                if pyarrow.types.is_list(column.type):
+                    values = pyarrow.compute.fill_null(column.values.cast(pyarrow.string()), "")
+                    column = pyarrow.ListArray.from_arrays(column.offsets, values, mask=column.is_null())
+                    column = pyarrow.compute.binary_join(column, ", ")
+                columns.append(column)
+            batch = pyarrow.RecordBatch.from_arrays(columns, names=batch.schema.names)
+        if self.writer is None:
+            if self.format == 'csv':
+                import pyarrow.csv
+                self.writer = pyarrow.csv.CSVWriter(self.path, batch.schema)
+            elif self.format == 'arrow':
+                import pyarrow.ipc
+                self.writer = pyarrow.ipc.new_file(self.path, batch.schema)
+            else:
+                import pyarrow.parquet
+                self.writer = pyarrow.parquet.ParquetWriter(self.path, batch.schema)
+        self.writer.write_batch(batch)
+
+    def close(self):
+        """Finish the file"""
+        if self.writer is not None:
+            self.writer.close()
+
+
+def matchColumn(prototype, values):
+    """Returns a boolean pyarrow array of values matched by a prototype regex
+
+    Matching runs in pyarrow's RE2 kernel. Patterns RE2 rejects (such as
+    repeats over 1000) fall back to re, tried only on values whose length
+    fits the pattern so that few Python objects are built."""
+    import pyarrow
+    import pyarrow.compute
+    try:
+        matched = pyarrow.compute.match_substring_regex(
+            values, prototype.regex.pattern, ignore_case=bool(prototype.regex.flags & re.IGNORECASE))
+    except pyarrow.ArrowInvalid:
+        try:
+            import re._parser as sre_parse
+        except ImportError:
+            import sre_parse
+        low, high = sre_parse.parse(prototype.regex.pattern, prototype.regex.flags).getwidth()
+        lengths = pyarrow.compute.utf8_length(values)
+        candidates = pyarrow.compute.and_(pyarrow.compute.greater_equal(lengths, low),
+                                          pyarrow.compute.less_equal(lengths, min(high, 1 << 30))).fill_null(False)
+        found = [prototype.regex.match(value) is not None for value in values.filter(candidates).to_pylist()]
+        matched = pyarrow.compute.replace_with_mask(candidates, candidates, pyarrow.array(found, type=pyarrow.bool_()))
+    return matched.fill_null(False)
+
+
+def identifyColumn(hashID, column):
+    """Returns prototype indexes, names and hashcat modes of a pyarrow string column
+
+    Indexes refer to the unpruned prototypes. Distinct values are matched
+    against every prototype with pyarrow kernels and the results are spread
+    back over the rows with a take, so no Python object is built per row."""
+    import pyarrow
+    import pyarrow.compute
+    if not pyarrow.types.is_dictionary(column.type):
+        column = pyarrow.compute.dictionary_encode(column)
+    values = pyarrow.compute.utf8_trim_whitespace(column.dictionary)
+    counts = pyarrow.repeat(pyarrow.scalar(0, pyarrow.int32()), len(values))
+    positions = [pyarrow.array([], type=pyarrow.uint64())]
+    indexes = [pyarrow.array([], type=pyarrow.int32())]
+    for index, prototype in zip(hashID.sourceIndexes, hashID.prototypes):
+        matched = matchColumn(prototype, values)
+        counts = pyarrow.compute.add(counts, matched.cast(pyarrow.int32()))
+        positions.append(pyarrow.compute.indices_nonzero(matched))
+        indexes.append(pyarrow.repeat(pyarrow.scalar(index, pyarrow.int32()), len(positions[-1])))
+    # Stable sort by value keeps every value's prototypes in table order
+    order = pyarrow.compute.sort_indices(pyarrow.concat_arrays(positions))
+    indexes = pyarrow.concat_arrays(indexes).take(order)
+    offsets = pyarrow.concat_arrays([pyarrow.array([0], type=pyarrow.int32()),
+                                     pyarrow.compute.cumulative_sum(counts).cast(pyarrow.int32())])
+
+    def spread(perPrototype, valueType):
+        nested = pyarrow.array(perPrototype, type=pyarrow.list_(valueType)).take(indexes)
+        ends = pyarrow.compute.cumulative_sum(pyarrow.compute.list_value_length(nested)).cast(pyarrow.int32())
+        bounds = pyarrow.concat_arrays([pyarrow.array([0], type=pyarrow.int32()), ends]).take(offsets)
+        return pyarrow.ListArray.from_arrays(bounds, pyarrow.compute.list_flatten(nested)).take(column.indices)
+
+    modes = [list(hashID.modesOf([index])) for index in range(len(hashID.source))]
+    return (pyarrow.ListArray.from_arrays(offsets, indexes).take(column.indices),
+            spread([[mode.name for mode in found] for found in modes], pyarrow.string()),
+            spread([[mode.hashcat for mode in found] for found in modes], pyarrow.int32()))
+
+
+def identifyBatches(hashID, batches, columnName):
+    """Yields RecordBatches extended with hashid_prototype, hashid_name and hashid_hashcat columns"""
+    import pyarrow
+    for batch in batches:
+        if columnName not in batch.schema.names:
+            raise KeyError("No column {0}".format(columnName))
+        column = batch.column(batch.schema.get_field_index(columnName))
+        if not pyarrow.types.is_string(column.type) and not pyarrow.types.is_dictionary(column.type):
+            column = column.cast(pyarrow.string())
+        prototypeIds, names, modes = identifyColumn(hashID, column)
+        yield pyarrow.RecordBatch.from_arrays(
+            batch.columns + [prototypeIds, names, modes],
+            names=batch.schema.names + ["hashid_prototype", "hashid_name", "hashid_hashcat"])
+
+
+checkpointInterval = 10
+
+
+class Checkpoint(object):
+
+    """Byte offsets and counters of a run to resume it after an interruption"""
+
+    def __init__(self, path):
+        super(Checkpoint, self).__init__()
+        self.path = path
+        self.inputs = {}
+        self.outfile = 0
+        self.counters = {"lines": 0, "identified": 0, "unknown": 0}
+
+    def load(self):
+        """Read the checkpoint file"""
+        with io.open(self.path, "r", encoding="utf-8") as f:
+            state = json.load(f)
+        self.inputs = state["inputs"]
+        self.outfile = state["outfile"]
+        self.counters = state["counters"]
+
+    @staticmethod
+    def key(position, string):
+        """Returns the inputs key of the INPUT given at position, so repeated INPUTs are told apart"""
+        return u"{0}:{1}".format(position, string)
+
+    def state(self):
+        """Returns a copy of the current state"""
+        return {"inputs": dict(self.inputs), "outfile": self.outfile, "counters": dict(self.counters)}
+
+    def save(self, state=None):
+        """Atomically replace the checkpoint file"""
+        state = state or self.state()
+        tmp = self.path + ".tmp"
+        with io.open(tmp, "w", encoding="utf-8") as f:
+            f.write(u"{0}".format(json.dumps(state)))
+            f.flush()
+            os.fsync(f.fileno())
+        getattr(os, "replace", os.rename)(tmp, self.path)
+
+
+def prototypesVersion(prototypes):
+    """Returns a digest of prototype definitions"""
+    digest = hashlib.sha1()
+    for prototype in prototypes:
+        digest.update(repr((prototype.regex.pattern, prototype.regex.flags, prototype.modes)).encode("utf-8"))
+    return digest.hexdigest()
+
+
+class HashStore(object):
+
+    """SQLite store of already identified hashes
+
+    Hashes are keyed by a truncated SHA-1 digest and map to the indexes of
+    their matching prototypes in the unpruned prototypes, so runs with
+    different -e, --only or --exclude share it. The store is emptied
+    whenever it was filled with different prototype definitions."""
+
+    def __init__(self, path, hashID, batchSize=500):
+        super(HashStore, self).__init__()
+        self.hashID = hashID
+        self.batchSize = batchSize
+        self.version = prototypesVersion(hashID.source)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode = WAL")
+        self.connection.execute("PRAGMA synchronous = NORMAL")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS hashes (digest BLOB PRIMARY KEY, prototypes TEXT)")
+        row = self.connection.execute("SELECT value FROM meta WHERE key = 'version'").fetchone()
+        if row is None or row[0] != self.version:
+            self.connection.execute("DELETE FROM hashes")
+            self.connection.execute("INSERT OR REPLACE INTO meta VALUES ('version', ?)", (self.version,))
+        self.connection.commit()
+
+    def lookup(self, digests):
+        """Returns stored prototype indexes of digests"""
+        found = {}
+        digests = list(digests)
+        for start in range(0, len(digests), self.batchSize):
+            chunk = digests[start:start + self.batchSize]
+            query = "SELECT digest, prototypes FROM hashes WHERE digest IN ({0})".format(",".join("?" * len(chunk)))
+            for digest, indexes in self.connection.execute(query, [sqlite3.Binary(digest) for digest in chunk]):
+                found[bytes(digest)] = tuple(int(index) for index in indexes.split(",") if index)
+        return found
+
+    def insert(self, identified):
+        """Store prototype indexes of digests"""
+        self.connection.executemany(
+            "INSERT OR REPLACE INTO hashes VALUES (?, ?)",
+            [(sqlite3.Binary(digest), ",".join(str(index) for index in indexes))
+             for digest, indexes in identified.items()])
+        self.connection.commit()
+
+    def identifyHashes(self, phashes, limit=None):
+        """Returns identified HashInfo of many hashes, identifying only those not stored yet"""
+        phashes = [phash.strip() for phash in phashes]
+        digests = [hashlib.sha1(phash.encode("utf-8")).digest()[:16] for phash in phashes]
+        found = self.lookup(set(digests))
+        missing = {}
+        for phash, digest in zip(phashes, digests):
+            if digest not in found and digest not in missing:
+                missing[digest] = tuple(self.hashID.identifyPrototypes(phash, pruned=False))
+        if missing:
+            self.insert(missing)
+            found.update(missing)
+        return [list(self.hashID.modesOf(found[digest], limit)) for digest in digests]
+
+    def close(self):
+        """Close the database"""
+        self.connection.close()
 
 
-def writeResult(identified_modes, outfile, hashcatMode=False, johnFormat=False, extended=False):
+def writeJson(path, data):
+    """Atomically replace path with data as JSON"""
+    with io.open(path + ".tmp", "w", encoding="utf-8") as f:
+        f.write(u"{0}".format(json.dumps(data, sort_keys=True)))
+        f.flush()
+        os.fsync(f.fileno())
+    getattr(os, "replace", os.rename)(path + ".tmp", path)
+
+
+def planShards(paths, shardSize):
+    """Returns a manifest splitting files into byte ranges of at most shardSize"""
+    shards = []
+    for name in paths:
+        path = os.path.abspath(name)
+        size = os.path.getsize(path)
+        for start in range(0, max(size, 1), shardSize):
+            shards.append({"id": len(shards), "name": name, "path": path,
+                           "start": start, "end": min(size, start + shardSize)})
+    return {"shards": shards}
+
+
+def loadManifest(directory):
+    """Returns the manifest written by planShards"""
+    with io.open(os.path.join(directory, "manifest.json"), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def shardName(shard):
+    """Returns the file name prefix of a shard"""
+    return "shard-{0:06d}".format(shard["id"])
+
+
+def claimShard(directory, shard):
+    """Returns whether this process won the shard
+
+    Claims are files created exclusively, which is atomic on local and
+    NFSv3+ file systems. Delete a claim to hand a shard of a dead worker
+    to another one."""
+    try:
+        fd = os.open(os.path.join(directory, shardName(shard) + ".claim"), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+    except OSError:
+        return False
+    os.write(fd, "{0} {1} {2}\n".format(socket.gethostname(), os.getpid(), int(time.time())).encode("utf-8"))
+    os.close(fd)
+    return True
+
+
+def readShard(infile, start, end, batchSize=1024):
+    """Yields batches of non-empty lines starting within [start, end) of a binary file"""
+    if start:
+        # The line holding start belongs to the previous shard
+        infile.seek(start - 1)
+        infile.readline()
+    else:
+        infile.seek(0)
+    offset = infile.tell()
+    batch = []
+    while offset < end:
+        line = infile.readline()
+        if not line:
+            break
+        offset += len(line)
+        line = line.decode("utf-8")
+        if line.strip():
+            batch.append(line)
+            if len(batch) == batchSize:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def mergeShards(directory, outfile):
+    """Write the output of all shards in order and return their combined summary"""
+    shards = loadManifest(directory)["shards"]
+    summary = {"lines": 0, "identified": 0, "unknown": 0, "types": {}}
+    for shard in shards:
+        if not os.path.isfile(os.path.join(directory, shardName(shard) + ".json")):
+            raise ValueError("{0} is not done yet".format(shardName(shard)))
+    for position, shard in enumerate(shards):
+        if not position or shards[position - 1]["path"] != shard["path"]:
+            outfile.write(u"--File '{0}'--\n".format(shard["name"]))
+        with io.open(os.path.join(directory, shardName(shard) + ".out"), "r", encoding="utf-8") as f:
+            for chunk in iter(lambda: f.read(1 << 20), u""):
+                outfile.write(chunk)
+        if position == len(shards) - 1 or shards[position + 1]["path"] != shard["path"]:
+            outfile.write(u"--End of file '{0}'--".format(shard["name"]))
+        with io.open(os.path.join(directory, shardName(shard) + ".json"), "r", encoding="utf-8") as f:
+            stats = json.load(f)
+        for key in ("lines", "identified", "unknown"):
+            summary[key] += stats[key]
+        for name, count in stats["types"].items():
+            summary["types"][name] = summary["types"].get(name, 0) + count
+    return summary
+
+
+def residentMemory():
+    """Returns the resident set size of this process in bytes, or its peak where unknown"""
+    try:
+        with io.open("/proc/self/statm", "rb") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (EnvironmentError, ValueError, AttributeError):
+        try:
+            import resource
+        except ImportError:
+            return 0
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class Metrics(object):
+
+    """Throughput counters of a run, reported as progress lines or Prometheus text
+
+    record() is called once per batch of lines and only adds a few numbers;
+    reports are rendered at most once per interval."""
+
+    buckets = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self, totalBytes=None, interval=2.0):
+        super(Metrics, self).__init__()
+        self.totalBytes = totalBytes
+        self.interval = interval
+        self.started = time.time()
+        self.nextReport = self.started + interval
+        self.lines = 0
+        self.bytes = 0
+        self.identified = 0
+        self.unknown = 0
+        self.batches = [0] * (len(self.buckets) + 1)
+        self.batchSeconds = 0.0
+
+    def record(self, lines, nbytes, identified, unknown, seconds):
+        """Add a batch of analyzed lines and return whether a report is due"""
+        self.lines += lines
+        self.bytes += nbytes
+        self.identified += identified
+        self.unknown += unknown
+        self.batchSeconds += seconds
+        for position, bound in enumerate(self.buckets):
+            if seconds <= bound:
+                self.batches[position] += 1
+                break
+        else:
+            self.batches[-1] += 1
+        return time.time() >= self.nextReport
+
+    def progress(self):
+        """Returns a human readable progress line"""
+        elapsed = max(time.time() - self.started, 1e-9)
+        bytesRate = self.bytes / elapsed
+        hashes = self.identified + self.unknown
+        line = u"[*] {0} lines, {1:.0f} lines/s, {2:.1f} MB/s, {3:.1%} unknown".format(
+            self.lines, self.lines / elapsed, bytesRate / 1e6, float(self.unknown) / hashes if hashes else 0.0)
+        if self.totalBytes and bytesRate:
+            left = int(max(0, self.totalBytes - self.bytes) / bytesRate)
+            line += u", ETA {0}:{1:02d}:{2:02d}".format(left // 3600, left // 60 % 60, left % 60)
+        return line + u", RSS {0:.1f} MB".format(residentMemory() / 1e6)
+
+    def prometheus(self):
+        """Returns the metrics in Prometheus text exposition format"""
+        lines = []
+        for name, kind, text, value in (
+                ("hashid_lines_total", "counter", "Lines analyzed", self.lines),
+                ("hashid_bytes_total", "counter", "Bytes of lines analyzed", self.bytes),
+                ("hashid_identified_total", "counter", "Hashes identified", self.identified),
+                ("hashid_unknown_total", "counter", "Hashes not identified", self.unknown),
+                ("hashid_resident_memory_bytes", "gauge", "Resident set size", residentMemory()),
+                ("hashid_elapsed_seconds", "gauge", "Seconds since start", time.time() - self.started)):
+            lines.append("# HELP {0} {1}".format(name, text))
+            lines.append("# TYPE {0} {1}".format(name, kind))
+            lines.append("{0} {1}".format(name, value))
+        lines.append("# HELP hashid_batch_seconds Seconds spent identifying a batch of lines")
+        lines.append("# TYPE hashid_batch_seconds histogram")
+        count = 0
+        for bound, batches in zip(self.buckets + ("+Inf",), self.batches):
+            count += batches
+            lines.append('hashid_batch_seconds_bucket{{le="{0}"}} {1}'.format(bound, count))
+        lines.append("hashid_batch_seconds_sum {0}".format(self.batchSeconds))
+        lines.append("hashid_batch_seconds_count {0}".format(count))
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port):
+        """Serve the metrics on localhost from a daemon thread"""
+        try:
+            from http.server import BaseHTTPRequestHandler, HTTPServer
+        except ImportError:
+            from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = metrics.prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(("127.0.0.1", port), Handler)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return server
+
+
+def referenceIdentify(prototypes, phash, extended=True, only=None, exclude=None):
+    """Returns identified HashInfo with the plain linear loop over all prototypes
+
+    Modes left out by extended, only and exclude are dropped afterwards
+    rather than pruned beforehand as HashID does."""
+    phash = phash.strip()
+    modes = [mode for prototype in prototypes if prototype.regex.match(phash) for mode in prototype.modes]
+    return [mode for mode in modes
+            if (extended or not mode.extended) and
+            (not only or modeMatches(mode, only)) and
+            not (exclude and modeMatches(mode, exclude))]
+
+
+def referenceRanked(prototypes, priority, phash, limit, extended=True, only=None, exclude=None):
+    """Returns what identifyHash(phash, limit) should yield, sorting all identified modes by priority"""
+    modes = referenceIdentify(prototypes, phash, extended, only, exclude)
+    modes.sort(key=lambda mode: priority.index(mode.name) if mode.name in priority else len(priority))
+    return modes[:limit]
+
+
+fuzzAlphabet = u"0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ$./+*:=-_#@!,{}() "
+
+
+def generateFromRegex(regex, rng=random, boundary=None, maxExtra=8, maxUnbounded=64):
+    """Returns a random string matched by a prototype regex
+
+    Repeats take their minimum or maximum count when boundary is 'min' or
+    'max' and a random count of at most maxExtra more than the minimum
+    otherwise, so optional groups such as salts and usernames are both left
+    out and filled in. Unbounded repeats stop at maxUnbounded more."""
+    try:
+        import re._parser as sre_parse
+    except ImportError:
+        import sre_parse
+
+    def fromSet(items):
+        chars = []
+        negate = False
+        for op, av in items:
+            op = str(op).upper()
+            if op == "NEGATE":
+                negate = True
+            elif op == "LITERAL":
+                chars.append(unichr(av))
+            elif op == "RANGE":
+                chars.extend(unichr(code) for code in range(av[0], av[1] + 1))
+            elif op == "CATEGORY":
+                chars.append(u" ")
+        if negate:
+            return rng.choice([char for char in fuzzAlphabet if char not in chars and char.swapcase() not in chars])
+        return rng.choice(chars)
+
+    def generate(pattern):
+        out = []
+        for op, av in pattern:
+            op = str(op).upper()
+            if op == "LITERAL":
+                out.append(unichr(av))
+            elif op == "NOT_LITERAL":
+                out.append(rng.choice([char for char in fuzzAlphabet if ord(char) != av]))
+            elif op == "ANY":
+                out.append(rng.choice(fuzzAlphabet.strip()))
+            elif op == "IN":
+                out.append(fromSet(av))
+            elif op == "BRANCH":
+                out.append(generate(rng.choice(av[1])))
+            elif op == "SUBPATTERN":
+                out.append(generate(av[-1]))
+            elif op in ("MAX_REPEAT", "MIN_REPEAT"):
+                low, high = av[0], av[1]
+                if high == sre_parse.MAXREPEAT:
+                    high = low + maxUnbounded
+                if boundary == "min":
+                    count = low
+                elif boundary == "max":
+                    count = high
+                else:
+                    count = rng.randint(low, min(high, low + maxExtra))
+                out.extend(generate(av[2]) for _ in range(count))
+        return u"".join(out)
+
+    return generate(sre_parse.parse(regex.pattern, regex.flags))
+
+
+def mutate(phash, rng=random):
+    """Returns a near miss of phash: one character inserted, deleted, replaced or case flipped"""
+    position = rng.randint(0, len(phash))
+    kind = rng.choice(("insert", "delete", "replace", "case", "space"))
+    if kind == "insert" or not phash:
+        return phash[:position] + rng.choice(fuzzAlphabet) + phash[position:]
+    position = min(position, len(phash) - 1)
+    if kind == "delete":
+        return phash[:position] + phash[position + 1:]
+    if kind == "replace":
+        return phash[:position] + rng.choice(fuzzAlphabet) + phash[position + 1:]
+    if kind == "case":
+        return phash[:position] + phash[position].swapcase() + phash[position + 1:]
+    return rng.choice((u" ", u"\t")) + phash + rng.choice((u"", u" ", u"\n"))
+
+
+def fuzzInputs(prototypes, count, rng=random):
+    """Returns count generated inputs per prototype, each followed by a near miss"""
+    inputs = []
+    for prototype in prototypes:
+        for i in range(count):
+            boundary = ("min", "max", None)[i % 3]
+            phash = generateFromRegex(prototype.regex, rng, boundary)
+            if rng.random() < 0.5:
+                # Mixed case; the prototypes ignore case but other engines might not
+                phash = u"".join(char.swapcase() if rng.random() < 0.3 else char for char in phash)
+            inputs.append(phash)
+            inputs.append(mutate(phash, rng))
+    return inputs
+
+
+def fuzzEngines(extended=True, only=None, exclude=None, storePath=":memory:"):
+    """Returns (name, engine, expected) triples of the alternative identification engines
+
+    An engine identifies a list of hashes at once; expected returns what it
+    should have identified for one hash, computed with the reference loop
+    over the module level prototypes and priority."""
+    hashID = HashID(only=only, exclude=exclude, extended=extended)
+    store = HashStore(storePath, hashID)
+    reference = lambda phash: referenceIdentify(prototypes, phash, extended, only, exclude)
+    engines = [
+        ("HashID", lambda phashes: [list(hashID.identifyHash(phash)) for phash in phashes], reference),
+        ("HashID --first", lambda phashes: [list(hashID.identifyHash(phash, 1)) for phash in phashes],
+         lambda phash: referenceRanked(prototypes, priority, phash, 1, extended, only, exclude)),
+        ("HashID --top 3", lambda phashes: [list(hashID.identifyHash(phash, 3)) for phash in phashes],
+         lambda phash: referenceRanked(prototypes, priority, phash, 3, extended, only, exclude)),
+        ("HashStore", lambda phashes: store.identifyHashes(phashes), reference),
+        ("HashStore (stored)", lambda phashes: store.identifyHashes(phashes), reference),
+    ]
+    try:
+        import pyarrow
+    except ImportError:
+        pass
+    else:
+        def column(phashes):
+            prototypeIds = identifyColumn(hashID, pyarrow.array(phashes, type=pyarrow.string()))[0]
+            return [list(hashID.modesOf(indexes)) for indexes in prototypeIds.to_pylist()]
+        engines.append(("identifyColumn", column, reference))
+    return engines
+
+
+FuzzResult = namedtuple('FuzzResult', ['name', 'seconds', 'mismatches'])
+
+
+def fuzz(inputs, engines, prototypes=prototypes):
+    """Returns a FuzzResult of the reference loop followed by one per engine
+
+    Mismatches are (input, expected, identified) triples."""
+    started = time.time()
+    for phash in inputs:
+        referenceIdentify(prototypes, phash)
+    results = [FuzzResult(name="reference", seconds=time.time() - started, mismatches=[])]
+    for name, engine, expected in engines:
+        started = time.time()
+        identified = engine(inputs)
+        seconds = time.time() - started
+        mismatches = []
+        for phash, modes in zip(inputs, identified):
+            wanted = expected(phash)
+            if list(modes) != wanted:
+                mismatches.append((phash, wanted, list(modes)))
+        results.append(FuzzResult(name=name, seconds=seconds, mismatches=mismatches))
+    return results
+
+
+def writeFuzzResults(results, count, outfile, limit=10):
+    """Write human readable output from fuzz"""
+    reference = max(results[0].seconds, 1e-9)
+    outfile.write(u"Fuzzed {0} inputs\n".format(count))
+    for result in results:
+        seconds = max(result.seconds, 1e-9)
+        outfile.write(u"[{0}] {1}: {2:.0f} hashes/s ({3:.2f}x reference), {4} mismatches\n".format(
+            "-" if result.mismatches else "+", result.name, count / seconds, reference / seconds, len(result.mismatches)))
+        for phash, wanted, modes in result.mismatches[:limit]:
+            outfile.write(u"    {0!r}: expected {1} but got {2}\n".format(
+                phash, [mode.name for mode in wanted], [mode.name for mode in modes]))
+
+
+def writeResult(identified_modes, outfile, hashcatMode=False, johnFormat=False):
     """Write human readable output from identifyHash"""
     count = 0
     hashTypes = ""
     for mode in identified_modes:
-        if not mode.extended or extended:
-            count += 1
-            hashTypes += u"[+] {0} ".format(mode.name)
-            if hashcatMode and mode.hashcat is not None:
-                hashTypes += "[Hashcat Mode: {0}]".format(mode.hashcat)
-            if johnFormat and mode.john is not None:
-                hashTypes += "[JtR Format: {0}]".format(mode.john)
-            hashTypes += "\n"
+        count += 1
+        hashTypes += u"[+] {0} ".format(mode.name)
+        if hashcatMode and mode.hashcat is not None:
+            hashTypes += "[Hashcat Mode: {0}]".format(mode.hashcat)
+        if johnFormat and mode.john is not None:
+            hashTypes += "[JtR Format: {0}]".format(mode.john)
+        hashTypes += "\n"
     outfile.write(hashTypes)
     if count == 0:
         outfile.write(u"[+] Unknown hash\n")
@@ -784,7 +1858,7 @@ def writeResult(identified_modes, outfile, hashcatMode=False, johnFormat=False,
 
 
 def main():
-    usage = "{0} [-h] [-e] [-m] [-j] [-o FILE] [--version] INPUT".format(os.path.basename(__file__))
+    usage = "{0} [-h] [-e] [-m] [-j] [-f FORMAT] [-s [--min-length N]] [--only TYPES] [--exclude TYPES] [--first | --top K] [-c NAME] [-o FILE] [--store FILE] [--checkpoint FILE [--resume]] [--follow] [--sample N | --sample-rate P] [--shard-plan DIR | --shard-worker DIR | --shard-merge DIR] [--progress] [--metrics-file FILE] [--metrics-port PORT] [--fuzz N] [--version] INPUT".format(os.path.basename(__file__))
 
     parser = argparse.ArgumentParser(
         description="Identify the different types of hashes used to encrypt data",
@@ -806,9 +1880,79 @@ def main():
     group.add_argument("-j", "--john",
                        action="store_true",
                        help="show corresponding JohnTheRipper format in output")
+    group.add_argument("-f", "--format",
+                       metavar="FORMAT", type=str, choices=sorted(lineFormats),
+                       help="parse input lines as {0}".format(", ".join(sorted(lineFormats))))
+    group.add_argument("-s", "--scan",
+                       action="store_true",
+                       help="find hashes embedded in free text and report their byte offsets "
+                            "(colons separate tokens, so 'hash:salt' is found as 'hash')")
+    group.add_argument("--min-length",
+                       metavar="N", type=int, default=16,
+                       help="shortest token considered by --scan (default: 16)")
+    group.add_argument("-c", "--column",
+                       metavar="NAME", type=str,
+                       help="identify column NAME of a CSV, Arrow or Parquet file and add result columns")
     group.add_argument("-o", "--outfile",
                        metavar="FILE", type=str,
                        help="write output to file")
+    group.add_argument("--store",
+                       metavar="FILE", type=str,
+                       help="remember identified hashes across runs in an SQLite database")
+    group.add_argument("--checkpoint",
+                       metavar="FILE", type=str,
+                       help="periodically and on Ctrl-C save progress to file")
+    group.add_argument("--resume",
+                       action="store_true",
+                       help="continue from the last --checkpoint")
+    group.add_argument("--follow",
+                       action="store_true",
+                       help="keep watching files and analyze appended lines")
+    group.add_argument("--only",
+                       metavar="TYPES", type=lambda value: value.split(","),
+                       help="only look for these comma separated hash names, hashcat modes or JtR formats")
+    group.add_argument("--exclude",
+                       metavar="TYPES", type=lambda value: value.split(","),
+                       help="never report these comma separated hash names, hashcat modes or JtR formats")
+    limiting = group.add_mutually_exclusive_group()
+    limiting.add_argument("--first",
+                          action="store_true",
+                          help="only show the most likely hash type")
+    limiting.add_argument("--top",
+                          metavar="K", type=int,
+                          help="only show the K most likely hash types")
+    sampling = group.add_mutually_exclusive_group()
+    sampling.add_argument("--sample",
+                          metavar="N", type=int,
+                          help="estimate hash type proportions from N sampled lines")
+    sampling.add_argument("--sample-rate",
+                          metavar="P", type=float,
+                          help="estimate hash type proportions from a fraction P of lines")
+    sharding = group.add_mutually_exclusive_group()
+    sharding.add_argument("--shard-plan",
+                          metavar="DIR", type=str,
+                          help="split INPUT files into shards listed in DIR/manifest.json")
+    sharding.add_argument("--shard-worker",
+                          metavar="DIR", type=str,
+                          help="claim and analyze unclaimed shards of DIR")
+    sharding.add_argument("--shard-merge",
+                          metavar="DIR", type=str,
+                          help="combine the results of all shards of DIR")
+    group.add_argument("--shard-size",
+                       metavar="BYTES", type=int, default=64 << 20,
+                       help="size of shards planned by --shard-plan (default: 64 MiB)")
+    group.add_argument("--progress",
+                       action="store_true",
+                       help="report throughput, time left, unknown ratio and memory on STDERR")
+    group.add_argument("--metrics-file",
+                       metavar="FILE", type=str,
+                       help="periodically write metrics in Prometheus text format to file")
+    group.add_argument("--metrics-port",
+                       metavar="PORT", type=int,
+                       help="serve metrics in Prometheus text format on localhost:PORT")
+    group.add_argument("--fuzz",
+                       metavar="N", type=int,
+                       help="compare all identification engines on N generated inputs per hash type and exit")
     group.add_argument("-h", "--help",
                        action="help",
                        help="show this help message and exit")
@@ -817,41 +1961,321 @@ def main():
                        version=__banner__)
     args = parser.parse_args()
 
-    hashID = HashID()
+    if args.first:
+        args.top = 1
+    if args.top is not None and args.top < 1:
+        parser.error("--top must be at least 1")
+
+    hashID = HashID(only=args.only, exclude=args.exclude, extended=args.extended)
+    if not hashID.prototypes:
+        parser.error("No hash types left to identify")
+
+    if args.fuzz:
+        inputs = fuzzInputs(prototypes, args.fuzz)
+        results = fuzz(inputs, fuzzEngines(args.extended, args.only, args.exclude))
+        writeFuzzResults(results, len(inputs), sys.stdout)
+        if any(result.mismatches for result in results):
+            sys.exit(1)
+        return
+
+    if args.min_length < 1:
+        parser.error("--min-length must be at least 1")
+    if args.scan and (args.format or args.store or args.progress or args.metrics_file or args.metrics_port):
+        parser.error("--scan cannot be combined with --format, --store, --progress or --metrics-*")
+    if args.follow and (not args.strings or args.strings[0] == "-"):
+        parser.error("--follow requires at least one FILE")
+    if args.follow and (args.scan or args.checkpoint):
+        parser.error("--follow cannot be combined with --scan or --checkpoint")
+    if args.sample is not None and args.sample < 1:
+        parser.error("--sample must be at least 1")
+    if args.sample_rate is not None and not 0 < args.sample_rate <= 1:
+        parser.error("--sample-rate must be between 0 and 1")
+    sampling = args.sample is not None or args.sample_rate is not None
+    if sampling and (args.scan or args.follow or args.checkpoint):
+        parser.error("--sample cannot be combined with --scan, --follow or --checkpoint")
+    if args.column and (len(args.strings) != 1 or not args.outfile):
+        parser.error("--column requires exactly one INPUT file and --outfile")
+    if args.column and (args.scan or args.follow or args.checkpoint or sampling or args.top or args.store or
+                        args.format or args.progress or args.metrics_file or args.metrics_port or
+                        args.mode or args.john):
+        parser.error("--column cannot be combined with --scan, --follow, --checkpoint, --sample, --top, "
+                     "--store, --format, --progress, --metrics-*, -m or -j")
+    sharding = args.shard_plan or args.shard_worker or args.shard_merge
+    if args.shard_plan and (not args.strings or not all(os.path.isfile(string) for string in args.strings)):
+        parser.error("--shard-plan requires INPUT files")
+    if sharding and (args.scan or args.follow or args.checkpoint or sampling or args.column):
+        parser.error("--shard-* cannot be combined with --scan, --follow, --checkpoint, --sample or --column")
+    if args.shard_worker and args.store:
+        # SQLite locking and WAL do not work over network filesystems
+        parser.error("--shard-worker cannot be combined with --store")
+    if args.resume and not args.checkpoint:
+        parser.error("--resume requires --checkpoint")
+    if args.checkpoint and not args.outfile:
+        parser.error("--checkpoint requires --outfile")
+    if args.checkpoint and (not args.strings or args.strings[0] == "-"):
+        parser.error("--checkpoint requires at least one INPUT")
+
+    if args.column:
+        try:
+            writer = BatchWriter(args.outfile)
+            try:
+                for batch in identifyBatches(hashID, readBatches(args.strings[0], columnName=args.column), args.column):
+                    writer.write(batch)
+            finally:
+                writer.close()
+        except ImportError:
+            parser.error("--column requires pyarrow (pip install hashID[arrow])")
+        except (EnvironmentError, ValueError, KeyError) as e:
+            parser.error("Could not convert {0}: {1}".format(args.strings[0], e))
+        return
 
     if not args.outfile:
         outfile = sys.stdout
     else:
         try:
-            outfile = io.open(args.outfile, "w", encoding="utf-8")
+            outfile = io.open(args.outfile, "a" if args.resume else "w", encoding="utf-8")
         except EnvironmentError:
             parser.error("Could not open {0}".format(args.output))
 
-    if not args.strings or args.strings[0] == "-":
-        while True:
-            line = sys.stdin.readline()
-            if not line:
-                break
-            outfile.write(u"Analyzing '{0}'\n".format(line.strip()))
-            writeResult(hashID.identifyHash(line), outfile, args.mode, args.john, args.extended)
-            sys.stdout.flush()
-    else:
-        for string in args.strings:
-            if os.path.isfile(string):
+    checkpoint = None
+    if args.checkpoint:
+        checkpoint = Checkpoint(args.checkpoint)
+        if args.resume and os.path.isfile(args.checkpoint):
+            try:
+                checkpoint.load()
+            except (EnvironmentError, ValueError, KeyError):
+                parser.error("Could not read checkpoint {0}".format(args.checkpoint))
+        if args.resume:
+            outfile.truncate(checkpoint.outfile)
+            # Truncating leaves the position where it was
+            outfile.seek(checkpoint.outfile)
+
+    # Last state where output and input offsets agree, saved on interruption
+    consistent = {}
+
+    def markCheckpoint():
+        outfile.flush()
+        checkpoint.outfile = outfile.tell()
+        consistent["state"] = checkpoint.state()
+
+    def saveCheckpoint(state=None):
+        outfile.flush()
+        os.fsync(outfile.fileno())
+        checkpoint.save(state)
+
+    def analyze(lines, target=None, stats=None, nbytes=None):
+        target = target or outfile
+        stats = stats or counters
+        started = time.time()
+        identifiedBefore, unknownBefore = stats["identified"], stats["unknown"]
+        fields = [field for line in lines for field in parseLine(line, args.format, hashID)]
+        if store is not None:
+            identified = store.identifyHashes([field.hash for field in fields], args.top)
+        else:
+            identified = [hashID.identifyHash(field.hash, args.top) for field in fields]
+        for field, modes in zip(fields, identified):
+            if field.username is None:
+                target.write(u"Analyzing '{0}'\n".format(field.hash))
+            else:
+                target.write(u"Analyzing '{0}' [User: {1}]\n".format(field.hash, field.username))
+            if "types" in stats:
+                modes = list(modes)
+                for mode in modes:
+                    stats["types"][mode.name] = stats["types"].get(mode.name, 0) + 1
+            if writeResult(modes, target, args.mode, args.john):
+                stats["identified"] += 1
+            else:
+                stats["unknown"] += 1
+        stats["lines"] += len(lines)
+        if metrics is None:
+            return
+        if nbytes is None:
+            nbytes = sum(len(line.encode("utf-8")) for line in lines)
+        if metrics.record(len(lines), nbytes, stats["identified"] - identifiedBefore,
+                          stats["unknown"] - unknownBefore, time.time() - started):
+            report()
+
+    def report(final=False):
+        if args.progress:
+            sys.stderr.write(metrics.progress() + (u"\n" if final or not sys.stderr.isatty() else u"\r"))
+            sys.stderr.flush()
+        if args.metrics_file:
+            with io.open(args.metrics_file + ".tmp", "w", encoding="utf-8") as f:
+                f.write(u"{0}".format(metrics.prometheus()))
+            getattr(os, "replace", os.rename)(args.metrics_file + ".tmp", args.metrics_file)
+        metrics.nextReport = time.time() + metrics.interval
+
+    def analyzeLines(infile, key, offset):
+        infile.seek(offset)
+        nextSave = time.time() + checkpointInterval
+        batch = []
+        batchStart = offset
+        for line in infile:
+            offset += len(line)
+            line = line.decode("utf-8")
+            if line.strip():
+                batch.append(line)
+                if len(batch) == 1024:
+                    analyze(batch, nbytes=offset - batchStart)
+                    batch = []
+                    batchStart = offset
+                    if checkpoint is not None:
+                        checkpoint.inputs[key] = {"offset": offset, "done": False}
+                        markCheckpoint()
+                        if time.time() >= nextSave:
+                            saveCheckpoint()
+                            nextSave = time.time() + checkpointInterval
+        analyze(batch, nbytes=offset - batchStart)
+
+    def scan(infile):
+        for offset, token, modes in scanText(hashID, infile, args.min_length, args.top):
+            outfile.write(u"Found '{0}' at offset {1}\n".format(token, offset))
+            writeResult(modes, outfile, args.mode, args.john)
+            counters["identified"] += 1
+
+    def sample(infile):
+        size = os.fstat(infile.fileno()).st_size
+        if args.sample_rate is not None:
+            probe = infile.read(65536)
+            lines = size * max(1, probe.count(b"\n")) / float(max(1, len(probe)))
+            samples = sampleFile(infile, max(1, int(math.ceil(args.sample_rate * lines))))
+        else:
+            samples = sampleFile(infile, args.sample)
+        # Inverse line lengths average to lines per byte
+        total = int(round(size * sum(weight for _, weight in samples) / max(1, len(samples))))
+        outfile.write(u"Sampled {0} of ~{1} lines\n".format(len(samples), total))
+        writeEstimates(estimateProportions(hashID, samples, args.format, args.top), outfile)
+
+    metrics = None
+    if args.progress or args.metrics_file or args.metrics_port:
+        totalBytes = sum(os.path.getsize(string) for string in args.strings if os.path.isfile(string))
+        if checkpoint is not None:
+            # Bytes handled before a resume are not left to do
+            for position, string in enumerate(args.strings):
+                progress = checkpoint.inputs.get(Checkpoint.key(position, string))
+                if progress is not None and os.path.isfile(string):
+                    totalBytes -= os.path.getsize(string) if progress["done"] else progress["offset"]
+        metrics = Metrics(max(0, totalBytes) or None)
+        if args.metrics_port:
+            try:
+                metrics.serve(args.metrics_port)
+            except EnvironmentError as e:
+                parser.error("Could not listen on port {0}: {1}".format(args.metrics_port, e))
+
+    store = None
+    if args.store:
+        try:
+            store = HashStore(args.store, hashID)
+        except sqlite3.Error as e:
+            parser.error("Could not open {0}: {1}".format(args.store, e))
+
+    def shardWork(directory):
+        for shard in loadManifest(directory)["shards"]:
+            if not claimShard(directory, shard):
+                continue
+            stats = {"lines": 0, "identified": 0, "unknown": 0, "types": {}}
+            path = os.path.join(directory, shardName(shard) + ".out")
+            with io.open(path + ".tmp", "w", encoding="utf-8") as target:
                 try:
-                    with io.open(string, "r", encoding="utf-8") as infile:
-                        outfile.write("--File '{0}'--\n".format(string))
-                        for line in infile:
-                            if line.strip():
-                                outfile.write(u"Analyzing '{0}'\n".format(line.strip()))
-                                writeResult(hashID.identifyHash(line), outfile, args.mode, args.john, args.extended)
+                    with io.open(shard["path"], "rb") as infile:
+                        for batch in readShard(infile, shard["start"], shard["end"]):
+                            analyze(batch, target, stats)
                 except (EnvironmentError, UnicodeDecodeError):
-                    outfile.write("--File '{0}' - could not open--".format(string))
-                else:
-                    outfile.write("--End of file '{0}'--".format(string))
+                    target.write("--File '{0}' - could not open--".format(shard["name"]))
+            getattr(os, "replace", os.rename)(path + ".tmp", path)
+            writeJson(os.path.join(directory, shardName(shard) + ".json"), stats)
+
+    counters = checkpoint.counters if checkpoint is not None else {"lines": 0, "identified": 0, "unknown": 0}
+
+    try:
+        if args.shard_plan:
+            try:
+                manifest = planShards(args.strings, args.shard_size)
+                if not os.path.isdir(args.shard_plan):
+                    os.makedirs(args.shard_plan)
+                writeJson(os.path.join(args.shard_plan, "manifest.json"), manifest)
+            except EnvironmentError as e:
+                parser.error("Could not plan shards: {0}".format(e))
+            outfile.write(u"Planned {0} shards in '{1}'\n".format(len(manifest["shards"]), args.shard_plan))
+        elif args.shard_worker:
+            try:
+                shardWork(args.shard_worker)
+            except (EnvironmentError, ValueError, KeyError) as e:
+                parser.error("Could not work on shards: {0}".format(e))
+        elif args.shard_merge:
+            try:
+                summary = mergeShards(args.shard_merge, outfile)
+            except (EnvironmentError, ValueError, KeyError) as e:
+                parser.error("Could not merge shards: {0}".format(e))
+            writeJson(os.path.join(args.shard_merge, "summary.json"), summary)
+        elif args.follow:
+            current = None
+            for batch in followLines(args.strings):
+                for string, lines in itertools.groupby(batch, lambda entry: entry[0]):
+                    if string != current:
+                        outfile.write("--File '{0}'--\n".format(string))
+                        current = string
+                    analyze([line for _, line in lines if line.strip()])
+                outfile.flush()
+        elif sampling and (not args.strings or args.strings[0] == "-"):
+            samples = sampleStream(sys.stdin, args.sample, args.sample_rate)
+            outfile.write(u"Sampled {0} lines\n".format(len(samples)))
+            writeEstimates(estimateProportions(hashID, samples, args.format, args.top), outfile)
+        elif not args.strings or args.strings[0] == "-":
+            if args.scan:
+                scan(getattr(sys.stdin, "buffer", sys.stdin))
             else:
-                outfile.write(u"Analyzing '{0}'\n".format(string.strip()))
-                writeResult(hashID.identifyHash(string), outfile, args.mode, args.john, args.extended)
+                while True:
+                    line = sys.stdin.readline()
+                    if not line:
+                        break
+                    analyze([line])
+                    sys.stdout.flush()
+        else:
+            if checkpoint is not None:
+                markCheckpoint()
+            try:
+                for position, string in enumerate(args.strings):
+                    key = Checkpoint.key(position, string)
+                    if checkpoint is not None:
+                        progress = checkpoint.inputs.get(key, {"offset": 0, "done": False})
+                        if progress["done"]:
+                            continue
+                    else:
+                        progress = {"offset": 0, "done": False}
+                    if os.path.isfile(string):
+                        try:
+                            with io.open(string, "rb") as infile:
+                                if not progress["offset"]:
+                                    outfile.write("--File '{0}'--\n".format(string))
+                                if args.scan:
+                                    scan(infile)
+                                elif sampling:
+                                    sample(infile)
+                                else:
+                                    analyzeLines(infile, key, progress["offset"])
+                        except (EnvironmentError, UnicodeDecodeError):
+                            outfile.write("--File '{0}' - could not open--".format(string))
+                        else:
+                            outfile.write("--End of file '{0}'--".format(string))
+                    elif args.scan:
+                        scan(io.BytesIO(string.encode("utf-8")))
+                    else:
+                        analyze([string])
+                    if checkpoint is not None:
+                        checkpoint.inputs[key] = {"offset": 0, "done": True}
+                        markCheckpoint()
+                        saveCheckpoint()
+            except KeyboardInterrupt:
+                if checkpoint is not None:
+                    saveCheckpoint(consistent["state"])
+                raise
+
+        if metrics is not None:
+            report(final=True)
+    finally:
+        if store is not None:
+            store.close()
 
 
 if __name__ == "__main__":
@@ -49,6 +49,9 @@ setup(
     download_url='https://github.com/psypanda/hashID/tarball/v' + get_version('hashid.py'),
     keywords='hashid hash identifier hash-identifier',
     py_modules=['hashid'],
+    extras_require={
+        'arrow': ['pyarrow'],
+    },
     entry_points={
         'console_scripts': [
             'hashid = hashid:main',